@@ -0,0 +1,121 @@
+"""
+Хранилища истории диалогов: в памяти процесса и в Redis
+"""
+
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+
+import orjson
+import redis.asyncio as redis
+
+
+class ConversationStore(ABC):
+    # История хранится ходами: ход начинается с текста пользователя, и обрезка целыми ходами
+    # не разрывает пару tool_use/tool_result. load() возвращает плоский список сообщений без
+    # ограничения длины — ход дописывает в него сколько угодно сообщений. append() сохраняет
+    # только сообщения нового хода, поэтому неудачный ход не меняет сохранённую историю
+
+    def __init__(self, max_turns: int, ttl: int):
+        self.max_turns = max_turns
+        self.ttl = ttl
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def load(self, conv_id: str) -> list:
+        ...
+
+    @abstractmethod
+    async def append(self, conv_id: str, messages: list):
+        ...
+
+    @abstractmethod
+    async def clear(self, conv_id: str):
+        ...
+
+
+class MemoryConversationStore(ConversationStore):
+    # conv_id -> (время последнего обращения, ходы). Порядок ключей — от давно
+    # не использованных к свежим, так что вытеснение идёт с начала
+
+    def __init__(self, max_turns: int, ttl: int, max_size: int, sweep_interval: float):
+        super().__init__(max_turns, ttl)
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self._data: OrderedDict[str, tuple[float, deque[list]]] = OrderedDict()
+        self._sweeper: asyncio.Task | None = None
+
+    async def start(self):
+        self._sweeper = asyncio.create_task(self._sweep())
+
+    async def close(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            deadline = time.monotonic() - self.ttl
+            while self._data:
+                conv_id, (touched, _) = next(iter(self._data.items()))
+                if touched > deadline:
+                    break
+                del self._data[conv_id]
+
+    async def load(self, conv_id: str) -> list:
+        entry = self._data.get(conv_id)
+        if entry is None:
+            return []
+        now = time.monotonic()
+        touched, turns = entry
+        # Просроченный диалог ещё мог не попасть под очистку — считаем его удалённым
+        if touched <= now - self.ttl:
+            del self._data[conv_id]
+            return []
+        # Обращение продлевает жизнь: время и позиция в порядке вытеснения меняются вместе
+        self._data[conv_id] = (now, turns)
+        self._data.move_to_end(conv_id)
+        return [message for turn in turns for message in turn]
+
+    async def append(self, conv_id: str, messages: list):
+        entry = self._data.get(conv_id)
+        turns = entry[1] if entry else deque(maxlen=self.max_turns)
+        turns.append(list(messages))
+        self._data[conv_id] = (time.monotonic(), turns)
+        self._data.move_to_end(conv_id)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    async def clear(self, conv_id: str):
+        self._data.pop(conv_id, None)
+
+
+class RedisConversationStore(ConversationStore):
+    # Общая история для всех воркеров, переживает рестарт; TTL ключа заменяет ручную чистку.
+    # Диалог — список Redis, по элементу (JSON-массиву сообщений) на ход: ход дописывается
+    # RPUSH, а LTRIM оставляет последние max_turns ходов — без чтения и перезаписи истории
+
+    def __init__(self, client: redis.Redis, max_turns: int, ttl: int):
+        super().__init__(max_turns, ttl)
+        self.redis = client
+
+    async def load(self, conv_id: str) -> list:
+        raw = await self.redis.lrange(f"turns:{conv_id}", 0, -1)
+        return [message for turn in raw for message in orjson.loads(turn)]
+
+    async def append(self, conv_id: str, messages: list):
+        key = f"turns:{conv_id}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, orjson.dumps(messages))
+            pipe.ltrim(key, -self.max_turns, -1)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def clear(self, conv_id: str):
+        await self.redis.delete(f"turns:{conv_id}")
@@ -2,19 +2,46 @@
 Just-Magic Tools для интеграции с Claude API
 """
 
-import json
-import gzip
-import csv
-import io
+import asyncio
+import codecs
+import contextlib
+import functools
+import itertools
 import logging
+import random
+import secrets
+import time
+import urllib.parse
+from typing import Annotated, AsyncIterator, Literal, Optional
 
 import httpx
+import orjson
+from pydantic import AfterValidator, BaseModel, Field, ValidationError
 
 logger = logging.getLogger(__name__)
 
 API_URL = "https://api.just-magic.org/api_v1.php"
+READ_CHUNK_SIZE = 64 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+GZIP_HEADERS = {"Content-Encoding": "gzip"}
+# Тела длиннее этого порога сжимаем, если сжатие запросов включено
+GZIP_MIN_SIZE = 4096
 
-TOOLS_DEFINITIONS = [
+# Действия только на чтение: их безопасно объединять и повторять
+IDEMPOTENT_ACTIONS = frozenset({"info", "list_tasks", "get_task"})
+
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.1
+# Ответы, после которых чтение имеет смысл повторить: перегрузка и сбои сервера
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Время жизни кэша (сек) для идемпотентных запросов на чтение
+CACHE_TTL = {"info": 60.0, "list_tasks": 10.0, "get_task": 5.0}
+CACHE_MAXSIZE = 512
+
+
+TOOLS_DEFINITIONS = (
     {
         "name": "justmagic_info",
         "description": "Получить информацию об аккаунте Just-Magic: тариф, баланс, срок действия",
@@ -51,7 +78,7 @@ TOOLS_DEFINITIONS = [
             "type": "object",
             "properties": {
                 "tid": {"type": "integer", "description": "ID задачи"},
-                "max_rows": {"type": "integer", "default": 100}
+                "max_rows": {"type": "integer", "minimum": 1, "default": 100}
             },
             "required": ["tid"]
         }
@@ -217,63 +244,441 @@ TOOLS_DEFINITIONS = [
             },
             "required": ["pattern"]
         }
-    }
-]
+    },
+)
+
+def _clamp(lo: int, hi: int) -> AfterValidator:
+    return AfterValidator(lambda v: min(max(v, lo), hi))
+
+
+SearchEngine = Literal["yandex", "google"]
+Lang = Literal["ru", "en"]
+MinPower = Annotated[int, _clamp(3, 9)]
+
+
+# Аргументы инструментов проверяются один раз на входе в execute();
+# значения по умолчанию совпадают со схемами TOOLS_DEFINITIONS (проверяет tests/test_justmagic_tools.py)
+class InfoArgs(BaseModel):
+    pass
+
+
+class ListTasksArgs(BaseModel):
+    limit: Annotated[int, AfterValidator(lambda v: min(v, 100))] = 10
+    offset: int = 0
+
+
+class GetTaskArgs(BaseModel):
+    tid: int
+    mode: Literal["info", "xlsx", "csv"] = "info"
+
+
+class DownloadResultArgs(BaseModel):
+    tid: int
+    max_rows: int = Field(100, ge=1)
+
+
+class ClusterArgs(BaseModel):
+    queries: list[str]
+    search_engine: SearchEngine = "yandex"
+    region: int = 213
+    google_lr: Optional[str] = None
+    lang: Lang = "ru"
+    label: Optional[str] = None
+    collect_frequency: bool = False
+    domain: Optional[str] = None
+    just_ask: bool = False
+
+
+class AnalyzerPage(BaseModel):
+    url: str
+    queries: list[str]
+
+
+class TextAnalyzerArgs(BaseModel):
+    pages: list[AnalyzerPage]
+    search_engine: SearchEngine = "yandex"
+    region: int = 213
+    just_ask: bool = False
+
+
+class AquarelleArgs(BaseModel):
+    keyword: str
+    text: str
+    search_engine: SearchEngine = "yandex"
+    lang: Lang = "ru"
+
+
+class AquarelleGeneratorArgs(BaseModel):
+    queries: list[str]
+    search_engine: SearchEngine = "yandex"
+    lang: Lang = "ru"
+    just_ask: bool = False
+
+
+class WordstatFrequencyArgs(BaseModel):
+    queries: list[str]
+    region: Optional[int] = None
+    device: Literal["all", "desktop", "tablet_phone"] = "all"
+    label: Optional[str] = None
+    s_std: bool = True
+    s_q: bool = False
+    just_ask: bool = False
+
+
+class SuggestionsParserArgs(BaseModel):
+    queries: list[str]
+    region: int = 213
+    lang: Lang = "ru"
+    iterations: Annotated[int, _clamp(1, 3)] = 1
+    add_russian_letters: bool = False
+    just_ask: bool = False
+
+
+class ThematicClassifierArgs(BaseModel):
+    queries: list[str]
+    show_all_categories: bool = False
+    just_ask: bool = False
+
+
+class MarkersPage(BaseModel):
+    url: str
+    queries: list[str] = []
+
+
+class MarkersOnlineArgs(BaseModel):
+    pages: list[MarkersPage]
+    base_queries: list[str]
+    region: int = 213
+    mode: Literal["hard", "soft"] = "hard"
+    min_power: MinPower = 3
+    just_ask: bool = False
+
+
+class ExpandSemanticsArgs(BaseModel):
+    queries: list[str]
+    base: int = 3
+    depth: Annotated[int, _clamp(0, 9)] = 1
+    min_power: MinPower = 3
+    just_ask: bool = False
+
+
+class RegexSearchArgs(BaseModel):
+    pattern: str
+    exclude_pattern: Optional[str] = None
+    base: int = 3
+    just_ask: bool = False
+
+
+_ARG_MODELS: dict[str, type[BaseModel]] = {
+    "justmagic_info": InfoArgs,
+    "justmagic_list_tasks": ListTasksArgs,
+    "justmagic_get_task": GetTaskArgs,
+    "justmagic_download_result": DownloadResultArgs,
+    "justmagic_cluster": ClusterArgs,
+    "justmagic_text_analyzer": TextAnalyzerArgs,
+    "justmagic_aquarelle": AquarelleArgs,
+    "justmagic_aquarelle_generator": AquarelleGeneratorArgs,
+    "justmagic_wordstat_frequency": WordstatFrequencyArgs,
+    "justmagic_suggestions_parser": SuggestionsParserArgs,
+    "justmagic_thematic_classifier": ThematicClassifierArgs,
+    "justmagic_markers_online": MarkersOnlineArgs,
+    "justmagic_expand_semantics": ExpandSemanticsArgs,
+    "justmagic_regex_search": RegexSearchArgs,
+}
+
+
+def _join_utf8(seq: list[str]) -> bytes:
+    # Кодируем в UTF-8 сразу при склейке — тело запроса не проходит через промежуточную str
+    if len(seq) == 1:
+        return seq[0].encode("utf-8")
+    return b"\n".join(s.encode("utf-8") for s in seq)
+
+
+def _encode_form(payload: dict) -> bytes:
+    # Собираем тело в один буфер: без списка пар "k=v", общего join и
+    # повторного кодирования
+    body = bytearray()
+    for key, value in payload.items():
+        if body:
+            body.extend(b"&")
+        body.extend(urllib.parse.quote_plus(key).encode("ascii"))
+        body.extend(b"=")
+        body.extend(urllib.parse.quote_plus(value).encode("ascii"))
+    return bytes(body)
+
+
+def _encode_multipart(payload: dict, boundary: bytes) -> bytes:
+    # Большие поля (data, data_base) — уже UTF-8 bytes: в multipart они идут как есть,
+    # а в urlencoded каждая кириллическая буква раздувается с 2 до 6 байт
+    body = bytearray()
+    for key, value in payload.items():
+        body.extend(b'--%b\r\nContent-Disposition: form-data; name="%b"\r\n\r\n' % (boundary, key.encode()))
+        body.extend(value if isinstance(value, bytes) else value.encode())
+        body.extend(b"\r\n")
+    body.extend(b"--%b--\r\n" % boundary)
+    return bytes(body)
+
+
+async def _backoff(attempt: int):
+    # Экспоненциальная пауза с полным джиттером — повторы разных запросов не синхронизируются
+    await asyncio.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+
+
+@functools.cache
+def _zlib():
+    # Модули распаковки нужны только при скачивании CSV — не грузим их при импорте.
+    # ISA-L в разы быстрее zlib на распаковке и совместим с ним по API
+    try:
+        from isal import isal_zlib
+        return isal_zlib
+    except ImportError:
+        import zlib
+        return zlib
+
+
+def create_client() -> httpx.AsyncClient:
+    # Все инструменты ходят на один хост — общий пул соединений с HTTP/2
+    # избавляет от повторных TCP/TLS-рукопожатий между вызовами.
+    # Клиент создаёт и закрывает владелец (lifespan приложения), а не модуль
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(120.0, connect=10.0),
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60),
+    )
+
+
+def _ends_in_quotes(line: str, in_quotes: bool) -> bool:
+    # Кавычки считаем по правилам csv: поле в кавычках открывает только кавычка в начале
+    # поля, "" внутри него — экранированная кавычка, а голая кавычка посреди поля
+    # (27" монитор) — обычный символ. True — строка кончилась внутри поля в кавычках
+    pos = 0
+    while True:
+        if in_quotes:
+            end = line.find('"', pos)
+            if end == -1:
+                return True
+            if line[end + 1:end + 2] == '"':
+                pos = end + 2
+                continue
+            in_quotes = False
+            pos = end + 1
+        start = line.find('"', pos)
+        if start == -1:
+            return False
+        in_quotes = start == 0 or line[start - 1] == "\t"
+        pos = start + 1
 
 
 class JustMagicTools:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, client: httpx.AsyncClient, compress_requests: bool = False):
         self.api_key = api_key
-        self.client = httpx.AsyncClient(timeout=120.0)
+        self.compress_requests = compress_requests
+        self.client = client
+        # Граница multipart одна на клиент: случайные 32 hex-символа не встречаются в данных
+        self._boundary = secrets.token_hex(16).encode()
+        self._multipart_headers = {"Content-Type": f"multipart/form-data; boundary={self._boundary.decode()}"}
+        self._cache: dict[tuple, tuple[float, dict]] = {}
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self._dispatch = {
+            "justmagic_info": self._tool_info,
+            "justmagic_list_tasks": self._tool_list_tasks,
+            "justmagic_get_task": self._tool_get_task,
+            "justmagic_download_result": self._tool_download_result,
+            "justmagic_cluster": self._tool_cluster,
+            "justmagic_text_analyzer": self._tool_text_analyzer,
+            "justmagic_aquarelle": self._tool_aquarelle,
+            "justmagic_aquarelle_generator": self._tool_aquarelle_generator,
+            "justmagic_wordstat_frequency": self._tool_wordstat_frequency,
+            "justmagic_suggestions_parser": self._tool_suggestions_parser,
+            "justmagic_thematic_classifier": self._tool_thematic_classifier,
+            "justmagic_markers_online": self._tool_markers_online,
+            "justmagic_expand_semantics": self._tool_expand_semantics,
+            "justmagic_regex_search": self._tool_regex_search,
+        }
     
-    async def _request(self, action: str, params: dict = None) -> dict:
-        data = {"action": action, "apikey": self.api_key}
-        if params:
-            data.update(params)
-        
-        files = {k: (None, str(v)) for k, v in data.items()}
+    async def _cached_request(self, key: tuple, ttl: float, coro_factory) -> dict:
+        now = time.monotonic()
+        cached = self._cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
         
-        try:
-            response = await self.client.post(API_URL, files=files)
-            return response.json()
-        except Exception as e:
-            logger.error(f"API error: {e}")
-            return {"err": "request_error", "errtxt": str(e)}
+        result = await coro_factory()
+        if not result.get("err"):
+            if len(self._cache) >= CACHE_MAXSIZE:
+                self._evict(now)
+            # Переставляем ключ в конец, чтобы порядок dict совпадал с временем записи
+            self._cache.pop(key, None)
+            self._cache[key] = (now + ttl, result)
+        return result
     
-    async def _request_binary(self, action: str, params: dict = None) -> tuple[bytes, dict]:
+    def _evict(self, now: float):
+        # Сначала выбрасываем протухшие записи, затем — самые старые
+        for key in [k for k, (expires, _) in self._cache.items() if expires <= now]:
+            del self._cache[key]
+        while len(self._cache) >= CACHE_MAXSIZE:
+            del self._cache[next(iter(self._cache))]
+    
+    def _payload(self, action: str, params: dict = None) -> dict:
         data = {"action": action, "apikey": self.api_key}
         if params:
-            data.update(params)
+            data = data | params
+        return {k: v if isinstance(v, bytes) else str(v) for k, v in data.items()}
+    
+    def _encode(self, payload: dict) -> tuple[bytes, dict]:
+        # Короткие скалярные запросы — urlencoded, запросы со списками запросов в bytes — multipart
+        if any(isinstance(v, bytes) for v in payload.values()):
+            return _encode_multipart(payload, self._boundary), self._multipart_headers
+        return _encode_form(payload), FORM_HEADERS
+    
+    async def _request(self, action: str, params: dict = None) -> dict:
+        payload = self._payload(action, params)
+        if action not in IDEMPOTENT_ACTIONS:
+            return await self._post(payload)
         
-        files = {k: (None, str(v)) for k, v in data.items()}
+        # Одинаковые параллельные чтения ждут один и тот же HTTP-запрос
+        key = tuple(sorted(payload.items()))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._post(payload))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+    
+    async def _post(self, payload: dict) -> dict:
+        body, body_headers = self._encode(payload)
+        content, headers = body, body_headers
+        if self.compress_requests and len(body) > GZIP_MIN_SIZE:
+            content, headers = _zlib().compress(body, 1, wbits=31), body_headers | GZIP_HEADERS
+        # Чтения повторяем при сетевых сбоях, put_task — никогда: задача могла создаться
+        attempts = RETRY_ATTEMPTS if payload["action"] in IDEMPOTENT_ACTIONS else 1
         
-        try:
-            response = await self.client.post(API_URL, files=files)
-            return response.content, dict(response.headers)
-        except Exception as e:
-            return None, {"error": str(e)}
+        for attempt in range(attempts):
+            try:
+                response = await self.client.post(API_URL, content=content, headers=headers)
+                if response.status_code == 415 and content is not body:
+                    # Сервер не принимает сжатые тела: 415 значит, что запрос не обработан
+                    logger.warning("API rejected gzip request body, disabling compression")
+                    self.compress_requests = False
+                    content, headers = body, body_headers
+                    response = await self.client.post(API_URL, content=content, headers=headers)
+                if response.status_code in RETRY_STATUSES and attempt + 1 < attempts:
+                    logger.warning(f"API HTTP {response.status_code}, retrying")
+                    await _backoff(attempt)
+                    continue
+                if response.status_code >= 400:
+                    # Тело ошибки — обычно HTML прокси, а не JSON API: разбирать его незачем
+                    logger.error(f"API HTTP {response.status_code}")
+                    return {"err": "http_error", "errtxt": f"HTTP {response.status_code}"}
+                return orjson.loads(await response.aread())
+            except httpx.TransportError as e:
+                if attempt + 1 == attempts:
+                    logger.error(f"API error: {e}")
+                    return {"err": "request_error", "errtxt": str(e)}
+                logger.warning(f"API transport error, retrying: {e}")
+                await _backoff(attempt)
+            except orjson.JSONDecodeError as e:
+                logger.error(f"API bad JSON: {e}")
+                return {"err": "bad_json", "errtxt": str(e)}
+            except Exception as e:
+                logger.error(f"API error: {e}")
+                return {"err": "request_error", "errtxt": str(e)}
     
-    async def _get_task_csv(self, tid: int) -> list[list]:
-        content, headers = await self._request_binary("get_task", {"tid": tid, "mode": "csv", "system": "unix"})
+    async def _request_binary(self, action: str, params: dict = None) -> AsyncIterator[bytes]:
+        content, headers = self._encode(self._payload(action, params))
         
-        if content is None:
-            return []
+        # Повторяем, как в _post, но только пока данные не пошли: после первого куска
+        # повтор продублировал бы строки. Статус ошибки — HTTPStatusError, а не тело страницы
+        for attempt in range(RETRY_ATTEMPTS):
+            started = False
+            try:
+                async with self.client.stream("POST", API_URL, content=content, headers=headers) as response:
+                    if response.status_code not in RETRY_STATUSES or attempt + 1 == RETRY_ATTEMPTS:
+                        response.raise_for_status()
+                        async for chunk in response.aiter_bytes(READ_CHUNK_SIZE):
+                            started = True
+                            yield chunk
+                        return
+                    logger.warning(f"API HTTP {response.status_code}, retrying")
+            except httpx.TransportError as e:
+                if started or attempt + 1 == RETRY_ATTEMPTS:
+                    raise
+                logger.warning(f"API transport error, retrying: {e}")
+            await _backoff(attempt)
+    
+    async def _get_task_csv(self, tid: int, max_rows: int) -> tuple[list[list], int | None]:
+        # Ответ распаковывается и разбирается по мере скачивания; как только набрано
+        # больше max_rows строк, поток закрывается. total_rows тогда неизвестен (None)
+        import csv
         
-        try:
-            error = json.loads(content)
-            if error.get("err"):
-                return []
-        except:
-            pass
+        limit = max_rows + 1
+        rows: list[list] = []
+        # csv.reader получает только целые записи: строки поля в кавычках с переводом
+        # строки копятся в record, пока кавычка не закроется
+        record: list[str] = []
+        in_quotes = False
+        tail = ""
+        
+        def feed(text: str, final: bool = False) -> None:
+            nonlocal in_quotes, tail
+            *complete, tail = (tail + text).split("\n")
+            ready: list[str] = []
+            for line in complete:
+                record.append(line + "\n")
+                in_quotes = _ends_in_quotes(line, in_quotes)
+                if not in_quotes:
+                    ready.extend(record)
+                    record.clear()
+            if final:
+                if tail:
+                    record.append(tail)
+                ready.extend(record)
+            rows.extend(itertools.islice(csv.reader(ready, delimiter='\t'), limit - len(rows)))
+        
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        decompressor = None
+        first = True
+        chunks = self._request_binary("get_task", {"tid": tid, "mode": "csv", "system": "unix"})
         
         try:
-            decompressed = gzip.decompress(content)
-            text = decompressed.decode('utf-8')
-        except:
-            text = content.decode('utf-8')
+            async with contextlib.aclosing(chunks):
+                async for chunk in chunks:
+                    if first:
+                        # Формат определяем по первым байтам, а не пробным разбором ответа
+                        first = False
+                        if chunk[:2] == GZIP_MAGIC:
+                            decompressor = _zlib().decompressobj(wbits=31)
+                        elif chunk[:1] in (b"{", b"["):
+                            chunk += b"".join([rest async for rest in chunks])
+                            try:
+                                error = orjson.loads(chunk)
+                            except orjson.JSONDecodeError:
+                                error = None
+                            if isinstance(error, dict) and error.get("err"):
+                                return [], 0
+                    
+                    if decompressor is not None:
+                        chunk = decompressor.decompress(chunk)
+                    feed(decoder.decode(chunk))
+                    if len(rows) == limit:
+                        return rows[:max_rows], None
+            
+            rest = b""
+            if decompressor is not None:
+                rest = decompressor.flush()
+                # Обрезанный gzip не бросает исключение: flush() отдаёт то, что успело распаковаться
+                if not decompressor.eof:
+                    raise _zlib().error("truncated gzip stream")
+            feed(decoder.decode(rest, final=True), final=True)
+        except httpx.HTTPError as e:
+            logger.error(f"API error: {e}")
+            return [], 0
+        except (_zlib().error, UnicodeDecodeError, csv.Error) as e:
+            logger.error(f"Corrupt CSV for task {tid}: {e}")
+            return [], 0
         
-        reader = csv.reader(io.StringIO(text), delimiter='\t')
-        return list(reader)
+        if len(rows) == limit:
+            return rows[:max_rows], None
+        return rows, len(rows)
     
     async def _put_task(self, task_data: dict, just_ask: bool = False) -> dict:
         params = dict(task_data)
@@ -281,165 +686,193 @@ class JustMagicTools:
             params["justask"] = 1
         return await self._request("put_task", params)
     
-    async def execute(self, name: str, args: dict) -> dict:
-        
-        if name == "justmagic_info":
-            return await self._request("info")
-        
-        elif name == "justmagic_list_tasks":
-            return await self._request("list_tasks", {
-                "limit": min(args.get("limit", 10), 100),
-                "offset": args.get("offset", 0)
-            })
-        
-        elif name == "justmagic_get_task":
-            return await self._request("get_task", {
-                "tid": args["tid"],
-                "mode": args.get("mode", "info")
-            })
-        
-        elif name == "justmagic_download_result":
-            data = await self._get_task_csv(args["tid"])
-            max_rows = args.get("max_rows", 100)
-            if not data:
-                return {"err": "no_data", "errtxt": "Не удалось получить данные"}
-            return {
-                "err": 0,
-                "total_rows": len(data),
-                "returned_rows": min(len(data), max_rows),
-                "data": data[:max_rows]
-            }
-        
-        elif name == "justmagic_cluster":
-            task_data = {
-                "task": "grp_onl",
-                "data": "\n".join(args["queries"]),
-                "search_engine": args.get("search_engine", "yandex"),
-                "lang": args.get("lang", "ru"),
-            }
-            if args.get("search_engine") == "google" and args.get("google_lr"):
-                task_data["google_lr"] = args["google_lr"]
-            else:
-                task_data["ya_lr"] = args.get("region", 213)
-            
-            if args.get("collect_frequency"):
-                task_data["s_std"] = 1
-            if args.get("label"):
-                task_data["label"] = args["label"]
-            if args.get("domain"):
-                task_data["domain"] = args["domain"]
-            
-            return await self._put_task(task_data, args.get("just_ask", False))
-        
-        elif name == "justmagic_text_analyzer":
-            lines = []
-            for p in args["pages"]:
-                for query in p["queries"]:
-                    lines.append(p["url"] + "\t" + query)
-            task_data = {
-                "task": "txt_anlz",
-                "data": "\n".join(lines),
-                "search_engine": args.get("search_engine", "yandex"),
-                "ya_lr": args.get("region", 213),
-            }
-            return await self._put_task(task_data, args.get("just_ask", False))
-        
-        elif name == "justmagic_aquarelle":
-            task_data = {
-                "task": "aqua",
-                "key": args["keyword"],
-                "data": args["text"],
-                "search_engine": args.get("search_engine", "yandex"),
-                "lang": args.get("lang", "ru"),
-            }
-            return await self._put_task(task_data, False)
-        
-        elif name == "justmagic_aquarelle_generator":
-            task_data = {
-                "task": "aqua_gen",
-                "data": "\n".join(args["queries"]),
-                "search_engine": args.get("search_engine", "yandex"),
-                "lang": args.get("lang", "ru"),
-            }
-            return await self._put_task(task_data, args.get("just_ask", False))
-        
-        elif name == "justmagic_wordstat_frequency":
-            task_data = {
-                "task": "wsfreq",
-                "data": "\n".join(args["queries"]),
-                "device": args.get("device", "all"),
-            }
-            if args.get("region"):
-                task_data["ya_lrws"] = args["region"]
-            if args.get("label"):
-                task_data["label"] = args["label"]
-            if args.get("s_std", True):
-                task_data["s_std"] = 1
-            if args.get("s_q"):
-                task_data["s_q"] = 1
-            
-            return await self._put_task(task_data, args.get("just_ask", False))
+    async def _tool_info(self, args: InfoArgs) -> dict:
+        return await self._cached_request(
+            ("info", frozenset()), CACHE_TTL["info"],
+            lambda: self._request("info")
+        )
+    
+    async def _tool_list_tasks(self, args: ListTasksArgs) -> dict:
+        params = {"limit": args.limit, "offset": args.offset}
+        return await self._cached_request(
+            ("list_tasks", frozenset(params.items())), CACHE_TTL["list_tasks"],
+            lambda: self._request("list_tasks", params)
+        )
+    
+    async def _tool_get_task(self, args: GetTaskArgs) -> dict:
+        params = {"tid": args.tid, "mode": args.mode}
+        if args.mode != "info":
+            return await self._request("get_task", params)
+        return await self._cached_request(
+            ("get_task", frozenset(params.items())), CACHE_TTL["get_task"],
+            lambda: self._request("get_task", params)
+        )
+    
+    async def _tool_download_result(self, args: DownloadResultArgs) -> dict:
+        data, total_rows = await self._get_task_csv(args.tid, args.max_rows)
+        if not data:
+            return {"err": "no_data", "errtxt": "Не удалось получить данные"}
+        return {
+            "err": 0,
+            "total_rows": total_rows,
+            "returned_rows": len(data),
+            "data": data
+        }
+    
+    async def _tool_cluster(self, args: ClusterArgs) -> dict:
+        task_data = {
+            "task": "grp_onl",
+            "data": _join_utf8(args.queries),
+            "search_engine": args.search_engine,
+            "lang": args.lang,
+        }
+        if args.search_engine == "google" and args.google_lr:
+            task_data["google_lr"] = args.google_lr
+        else:
+            task_data["ya_lr"] = args.region
         
-        elif name == "justmagic_suggestions_parser":
-            task_data = {
-                "task": "sug_par",
-                "data": "\n".join(args["queries"]),
-                "ya_lr": args.get("region", 213),
-                "lang": args.get("lang", "ru"),
-                "iter": min(max(args.get("iterations", 1), 1), 3),
-            }
-            if args.get("add_russian_letters"):
-                task_data["f_rus"] = 1
-            
-            return await self._put_task(task_data, args.get("just_ask", False))
+        if args.collect_frequency:
+            task_data["s_std"] = 1
+        if args.label:
+            task_data["label"] = args.label
+        if args.domain:
+            task_data["domain"] = args.domain
         
-        elif name == "justmagic_thematic_classifier":
-            task_data = {
-                "task": "temakl",
-                "data": "\n".join(args["queries"]),
-            }
-            if args.get("show_all_categories"):
-                task_data["f_gall"] = 1
-            
-            return await self._put_task(task_data, args.get("just_ask", False))
+        return await self._put_task(task_data, args.just_ask)
+    
+    async def _tool_text_analyzer(self, args: TextAnalyzerArgs) -> dict:
+        buf = bytearray()
+        for p in args.pages:
+            prefix = p.url.encode("utf-8") + b"\t"
+            for query in p.queries:
+                buf.extend(prefix)
+                buf.extend(query.encode("utf-8"))
+                buf.extend(b"\n")
+        del buf[-1:]
+        task_data = {
+            "task": "txt_anlz",
+            "data": bytes(buf),
+            "search_engine": args.search_engine,
+            "ya_lr": args.region,
+        }
+        return await self._put_task(task_data, args.just_ask)
+    
+    async def _tool_aquarelle(self, args: AquarelleArgs) -> dict:
+        task_data = {
+            "task": "aqua",
+            "key": args.keyword,
+            "data": args.text,
+            "search_engine": args.search_engine,
+            "lang": args.lang,
+        }
+        return await self._put_task(task_data, False)
+    
+    async def _tool_aquarelle_generator(self, args: AquarelleGeneratorArgs) -> dict:
+        task_data = {
+            "task": "aqua_gen",
+            "data": _join_utf8(args.queries),
+            "search_engine": args.search_engine,
+            "lang": args.lang,
+        }
+        return await self._put_task(task_data, args.just_ask)
+    
+    async def _tool_wordstat_frequency(self, args: WordstatFrequencyArgs) -> dict:
+        task_data = {
+            "task": "wsfreq",
+            "data": _join_utf8(args.queries),
+            "device": args.device,
+        }
+        if args.region:
+            task_data["ya_lrws"] = args.region
+        if args.label:
+            task_data["label"] = args.label
+        if args.s_std:
+            task_data["s_std"] = 1
+        if args.s_q:
+            task_data["s_q"] = 1
         
-        elif name == "justmagic_markers_online":
-            lines = [
-                p["url"] + ("\t" + "\t".join(p.get("queries", [])) if p.get("queries") else "")
-                for p in args["pages"]
-            ]
-            task_data = {
-                "task": "mark_onl",
-                "data": "\n".join(lines),
-                "data_base": "\n".join(args["base_queries"]),
-                "ya_lr": args.get("region", 213),
-                "mode": args.get("mode", "hard"),
-                "min_pwr": min(max(args.get("min_power", 3), 3), 9),
-            }
-            return await self._put_task(task_data, args.get("just_ask", False))
+        return await self._put_task(task_data, args.just_ask)
+    
+    async def _tool_suggestions_parser(self, args: SuggestionsParserArgs) -> dict:
+        task_data = {
+            "task": "sug_par",
+            "data": _join_utf8(args.queries),
+            "ya_lr": args.region,
+            "lang": args.lang,
+            "iter": args.iterations,
+        }
+        if args.add_russian_letters:
+            task_data["f_rus"] = 1
         
-        elif name == "justmagic_expand_semantics":
-            task_data = {
-                "task": "grp_deep",
-                "data": "\n".join(args["queries"]),
-                "base": args.get("base", 3),
-                "deep": min(max(args.get("depth", 1), 0), 9),
-                "min_pwr": min(max(args.get("min_power", 3), 3), 9),
-            }
-            return await self._put_task(task_data, args.get("just_ask", False))
+        return await self._put_task(task_data, args.just_ask)
+    
+    async def _tool_thematic_classifier(self, args: ThematicClassifierArgs) -> dict:
+        task_data = {
+            "task": "temakl",
+            "data": _join_utf8(args.queries),
+        }
+        if args.show_all_categories:
+            task_data["f_gall"] = 1
         
-        elif name == "justmagic_regex_search":
-            task_data = {
-                "task": "rexp",
-                "base": args.get("base", 3),
-                "rexpa": args["pattern"],
-            }
-            if args.get("exclude_pattern"):
-                task_data["rexpd"] = args["exclude_pattern"]
-            
-            return await self._put_task(task_data, args.get("just_ask", False))
+        return await self._put_task(task_data, args.just_ask)
+    
+    async def _tool_markers_online(self, args: MarkersOnlineArgs) -> dict:
+        buf = bytearray()
+        for p in args.pages:
+            buf.extend(p.url.encode("utf-8"))
+            if p.queries:
+                buf.extend(b"\t")
+                buf.extend("\t".join(p.queries).encode("utf-8"))
+            buf.extend(b"\n")
+        del buf[-1:]
+        task_data = {
+            "task": "mark_onl",
+            "data": bytes(buf),
+            "data_base": _join_utf8(args.base_queries),
+            "ya_lr": args.region,
+            "mode": args.mode,
+            "min_pwr": args.min_power,
+        }
+        return await self._put_task(task_data, args.just_ask)
+    
+    async def _tool_expand_semantics(self, args: ExpandSemanticsArgs) -> dict:
+        task_data = {
+            "task": "grp_deep",
+            "data": _join_utf8(args.queries),
+            "base": args.base,
+            "deep": args.depth,
+            "min_pwr": args.min_power,
+        }
+        return await self._put_task(task_data, args.just_ask)
+    
+    async def _tool_regex_search(self, args: RegexSearchArgs) -> dict:
+        task_data = {
+            "task": "rexp",
+            "base": args.base,
+            "rexpa": args.pattern,
+        }
+        if args.exclude_pattern:
+            task_data["rexpd"] = args.exclude_pattern
         
-        return {"err": "unknown_tool", "errtxt": f"Неизвестный инструмент: {name}"}
+        return await self._put_task(task_data, args.just_ask)
+    
+    async def execute(self, name: str, args: dict) -> dict:
+        handler = self._dispatch.get(name)
+        if handler is None:
+            return {"err": "unknown_tool", "errtxt": f"Неизвестный инструмент: {name}"}
+        try:
+            parsed = _ARG_MODELS[name].model_validate(args)
+        except ValidationError as e:
+            return {"err": "bad_args", "errtxt": str(e)}
+        return await handler(parsed)
     
-    async def close(self):
-        await self.client.aclose()
+    async def execute_many(self, calls: list[tuple[str, dict]]) -> list[dict]:
+        # Независимые вызовы выполняются параллельно; порядок результатов совпадает с calls
+        results = await asyncio.gather(
+            *(self.execute(name, args) for name, args in calls),
+            return_exceptions=True
+        )
+        return [
+            {"err": "exception", "errtxt": str(r)} if isinstance(r, Exception) else r
+            for r in results
+        ]
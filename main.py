@@ -4,20 +4,32 @@ Telegram Mini App Backend для SEO-ассистента на Claude
 """
 
 import os
-import json
+import re
+import asyncio
+import hashlib
 import logging
-from typing import Optional
-from datetime import datetime
+import secrets
+import time
+from functools import lru_cache
+from typing import Annotated, Optional
+from datetime import datetime, timezone
 from contextlib import asynccontextmanager
+from pathlib import Path
+from weakref import WeakValueDictionary
 
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
-from pydantic import BaseModel
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, field_validator
 import anthropic
+import orjson
+import redis.asyncio as redis
 
-from justmagic_tools import JustMagicTools, TOOLS_DEFINITIONS
+from conversation_store import ConversationStore, MemoryConversationStore, RedisConversationStore
+from response_cache import MemoryResponseCache, RedisResponseCache, ResponseCache
+from justmagic_tools import JustMagicTools, TOOLS_DEFINITIONS, create_client
 
 # Настройка логов
 logging.basicConfig(level=logging.INFO)
@@ -27,6 +39,27 @@ logger = logging.getLogger(__name__)
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
 JUSTMAGIC_API_KEY = os.environ.get("JUSTMAGIC_API_KEY")
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
+REDIS_URL = os.environ.get("REDIS_URL")
+JUSTMAGIC_GZIP_REQUESTS = os.environ.get("JUSTMAGIC_GZIP_REQUESTS") == "1"
+# Сторонние origin'ы, которым разрешено ходить в API из браузера (через запятую).
+# Mini App обращается к API со своего же origin, поэтому по умолчанию CORS выключен
+ALLOWED_ORIGINS = [o.strip() for o in os.environ.get("ALLOWED_ORIGINS", "").split(",") if o.strip()]
+# SDK сам повторяет 408/409/429/5xx и сетевые ошибки с экспоненциальной паузой и учётом retry-after
+ANTHROPIC_MAX_RETRIES = 4
+
+# Сколько последних ходов диалога хранить и как долго (сек) держать неактивный диалог
+HISTORY_TURNS = 20
+CONVERSATION_TTL = 3600
+# Предел числа диалогов в памяти процесса (без Redis) и период чистки неактивных
+CONVERSATIONS_MAX = 10_000
+CONVERSATIONS_SWEEP_INTERVAL = 300
+# Сколько символов результата инструмента оставлять в сохранённой истории
+TOOL_RESULT_PREVIEW = 4096
+# Сколько запросов к чату одного пользователя могут выполняться одновременно
+CHAT_CONCURRENCY_PER_USER = 4
+# Готовые ответы Claude на точно такой же запрос: срок жизни (сек) и предел записей в памяти
+RESPONSE_CACHE_TTL = 24 * 3600
+RESPONSE_CACHE_MAX = 1000
 
 # Системный промпт для Claude
 SYSTEM_PROMPT = """Ты — SEO-ассистент, работающий через Telegram Mini App.
@@ -51,166 +84,470 @@ SYSTEM_PROMPT = """Ты — SEO-ассистент, работающий чер
 Отвечай кратко и по делу. Используй инструменты когда нужно выполнить SEO-задачу.
 """
 
+# Системный промпт и описания инструментов одинаковы во всех запросах — помечаем их
+# точкой кэширования, чтобы Anthropic переиспользовал этот префикс между вызовами
+EPHEMERAL_CACHE = {"type": "ephemeral"}
+SYSTEM_BLOCKS = [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": EPHEMERAL_CACHE}]
+# SDK принимает tools только как объекты Python и сериализует их сам — заранее
+# сериализованные байты передать некуда, поэтому собираем кортеж один раз при импорте
+TOOLS = (*TOOLS_DEFINITIONS[:-1], {**TOOLS_DEFINITIONS[-1], "cache_control": EPHEMERAL_CACHE})
+
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+CLAUDE_MAX_TOKENS = 4096
+# Неизменная часть ключа кэша ответов: смена модели, промпта или инструментов его сбрасывает
+RESPONSE_KEY_PREFIX = hashlib.sha256(
+    orjson.dumps([CLAUDE_MODEL, CLAUDE_MAX_TOKENS, SYSTEM_BLOCKS, TOOLS])
+).digest()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Starting SEO Bot Backend...")
+    # Без ключей сервис бесполезен — падаем при старте, а не на каждом запросе
+    missing = [name for name in ("ANTHROPIC_API_KEY", "JUSTMAGIC_API_KEY") if not os.environ.get(name)]
+    if missing:
+        raise RuntimeError(f"Not configured: {', '.join(missing)}")
+    # Один экземпляр на процесс: кэш, single-flight и пул соединений общие для всех запросов
+    app.state.http_client = create_client()
+    app.state.jm_tools = JustMagicTools(JUSTMAGIC_API_KEY, app.state.http_client, JUSTMAGIC_GZIP_REQUESTS)
+    app.state.anthropic = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, max_retries=ANTHROPIC_MAX_RETRIES)
+    # С Redis история и кэш ответов общие для всех воркеров и переживают рестарт;
+    # без него — в памяти процесса
+    app.state.redis = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+    if app.state.redis:
+        app.state.conversations = RedisConversationStore(app.state.redis, HISTORY_TURNS, CONVERSATION_TTL)
+        app.state.response_cache = RedisResponseCache(app.state.redis, RESPONSE_CACHE_TTL)
+    else:
+        app.state.conversations = MemoryConversationStore(
+            HISTORY_TURNS, CONVERSATION_TTL, CONVERSATIONS_MAX, CONVERSATIONS_SWEEP_INTERVAL
+        )
+        app.state.response_cache = MemoryResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX)
+    await app.state.conversations.start()
+    # Страница Mini App не меняется до рестарта — читаем её один раз
+    app.state.index_html = Path("static/index.html").read_bytes()
+    app.state.index_etag = f'"{hashlib.md5(app.state.index_html).hexdigest()}"'
     yield
     logger.info("Shutting down...")
+    # Недописанные ходы сохраняем до закрытия хранилища
+    await asyncio.gather(*_pending_saves.values())
+    await app.state.conversations.close()
+    if app.state.redis:
+        await app.state.redis.aclose()
+    await app.state.anthropic.close()
+    await app.state.http_client.aclose()
 
 
 app = FastAPI(
     title="Telegram SEO Bot",
     description="SEO-ассистент на Claude с Just-Magic",
-    lifespan=lifespan
+    lifespan=lifespan,
+    # JSON-ответы (результаты задач Just-Magic бывают крупными) сериализует orjson
+    default_response_class=ORJSONResponse
 )
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Сжимаем ответы от 1 КБ: результаты задач и ответы чата — повторяющийся JSON/текст
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+if ALLOWED_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=ALLOWED_ORIGINS,
+        allow_methods=["GET", "POST"],
+        allow_headers=["Content-Type"],
+    )
 
 
 class ChatMessage(BaseModel):
+    # Лишние поля и слишком длинные строки отклоняются при разборе, до обращения к Claude
+    model_config = ConfigDict(extra="forbid", str_max_length=32_000)
+    
     message: str
     user_id: Optional[str] = None
     conversation_id: Optional[str] = None
+    
+    @field_validator("user_id")
+    @classmethod
+    def _normalize_user_id(cls, value: Optional[str]) -> Optional[str]:
+        # user_id попадает в conversation_id и ключи Redis — обрезаем пробелы и длину
+        if value is None:
+            return None
+        return value.strip()[:64] or None
+
+
+class ToolCallLog(BaseModel):
+    tool: str
+    input: dict
+    result_preview: str
 
 
 class ChatResponse(BaseModel):
     response: str
-    tool_calls: Optional[list] = None
+    tool_calls: Optional[list[ToolCallLog]] = None
     conversation_id: str
 
 
-# Хранилище диалогов (в проде использовать Redis/PostgreSQL)
-conversations: dict[str, list] = {}
+def get_conversations(request: Request) -> ConversationStore:
+    return request.app.state.conversations
 
 
-def get_anthropic_client() -> anthropic.Anthropic:
-    if not ANTHROPIC_API_KEY:
-        raise HTTPException(status_code=500, detail="ANTHROPIC_API_KEY not configured")
-    return anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+def _content_to_dicts(content: list) -> list[dict]:
+    # Блоки ответа SDK храним как обычные dict — их можно сериализовать и отправить обратно
+    return [block.model_dump(exclude_none=True) for block in content]
 
 
-def get_justmagic_tools() -> JustMagicTools:
-    if not JUSTMAGIC_API_KEY:
-        raise HTTPException(status_code=500, detail="JUSTMAGIC_API_KEY not configured")
-    return JustMagicTools(JUSTMAGIC_API_KEY)
+def _with_cache_breakpoint(history: list) -> list:
+    # Точка кэширования на последнем блоке: следующий вызов в цикле tool_use и следующий
+    # ход диалога читают всю предыдущую историю из кэша. Сама история не меняется
+    messages = list(history)
+    last = messages[-1]
+    content = last["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [*content[:-1], {**content[-1], "cache_control": EPHEMERAL_CACHE}]
+    messages[-1] = {**last, "content": content}
+    return messages
 
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    return FileResponse("static/index.html")
+def _compact_tool_results(messages: list):
+    # Полные результаты инструментов нужны только в пределах хода; в сохранённой истории
+    # оставляем начало, чтобы не пересылать мегабайты CSV на каждом следующем ходе
+    for message in messages:
+        if message["role"] != "user" or isinstance(message["content"], str):
+            continue
+        for block in message["content"]:
+            content = block.get("content")
+            if block.get("type") == "tool_result" and len(content) > TOOL_RESULT_PREVIEW:
+                block["content"] = f"{content[:TOOL_RESULT_PREVIEW]}\n… [обрезано, всего {len(content)} символов]"
 
 
-@app.get("/health")
-async def health():
-    return {
+def get_response_cache(request: Request) -> ResponseCache:
+    return request.app.state.response_cache
+
+
+def get_anthropic_client(request: Request) -> anthropic.AsyncAnthropic:
+    return request.app.state.anthropic
+
+
+def get_justmagic_tools(request: Request) -> JustMagicTools:
+    return request.app.state.jm_tools
+
+
+# Зависимости FastAPI: клиенты — синглтоны из lifespan, в обработчики приходят готовыми
+Conversations = Annotated[ConversationStore, Depends(get_conversations)]
+ResponseCacheDep = Annotated[ResponseCache, Depends(get_response_cache)]
+AnthropicClient = Annotated[anthropic.AsyncAnthropic, Depends(get_anthropic_client)]
+JustMagic = Annotated[JustMagicTools, Depends(get_justmagic_tools)]
+
+
+@app.get("/", response_class=HTMLResponse)
+async def root(request: Request):
+    headers = {"ETag": request.app.state.index_etag, "Cache-Control": "public, max-age=60, must-revalidate"}
+    if request.headers.get("if-none-match") == request.app.state.index_etag:
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(request.app.state.index_html, headers=headers)
+
+
+@lru_cache(maxsize=1)
+def _health_body(second: int) -> bytes:
+    # Ответ меняется только вместе с меткой времени, раз в секунду, — между соседними
+    # проверками отдаём готовые байты
+    return orjson.dumps({
         "status": "ok",
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": datetime.fromtimestamp(second, timezone.utc).isoformat(),
         "anthropic_configured": bool(ANTHROPIC_API_KEY),
         "justmagic_configured": bool(JUSTMAGIC_API_KEY),
         "telegram_configured": bool(TELEGRAM_BOT_TOKEN)
+    })
+
+
+@app.get("/health")
+async def health():
+    return Response(_health_body(int(time.time())), media_type="application/json")
+
+
+def _claude_request(history: list, user_id: Optional[str]) -> dict:
+    return {
+        "model": CLAUDE_MODEL,
+        "max_tokens": CLAUDE_MAX_TOKENS,
+        "system": SYSTEM_BLOCKS,
+        "tools": TOOLS,
+        "messages": _with_cache_breakpoint(history),
+        "metadata": {"user_id": user_id} if user_id else anthropic.NOT_GIVEN,
     }
 
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatMessage):
-    conv_id = request.conversation_id or f"conv_{request.user_id or 'anon'}_{datetime.now().timestamp()}"
+def _log_usage(usage):
+    # Доля префикса, прочитанного из кэша, — проверка, что точки кэширования срабатывают
+    logger.info(
+        f"Claude usage: input={usage.input_tokens} output={usage.output_tokens} "
+        f"cache_read={usage.cache_read_input_tokens} cache_write={usage.cache_creation_input_tokens}"
+    )
+
+
+def _response_key(history: list) -> str:
+    # metadata в ключ не входит: одинаковый вопрос разных пользователей — одна запись
+    digest = hashlib.sha256(RESPONSE_KEY_PREFIX)
+    digest.update(orjson.dumps(history))
+    return digest.hexdigest()
+
+
+async def _cached_response(cache: ResponseCache, key: str) -> Optional[anthropic.types.Message]:
+    raw = await cache.get(key)
+    if raw is None:
+        return None
+    logger.info("Claude response cache hit")
+    return anthropic.types.Message.model_validate_json(raw)
+
+
+async def _remember_response(cache: ResponseCache, key: str, response: anthropic.types.Message):
+    # Ответы с вызовом инструментов не кэшируем: инструменты должны выполниться заново
+    if response.stop_reason != "tool_use":
+        await cache.set(key, response.model_dump_json().encode())
+
+
+async def _ask_claude(
+    client: anthropic.AsyncAnthropic, cache: ResponseCache, history: list, user_id: Optional[str]
+) -> anthropic.types.Message:
+    key = _response_key(history)
+    response = await _cached_response(cache, key)
+    if response is None:
+        response = await client.messages.create(**_claude_request(history, user_id))
+        _log_usage(response.usage)
+        await _remember_response(cache, key, response)
+    return response
+
+
+async def _run_tools(jm_tools: JustMagicTools, tool_uses: list) -> tuple[list[dict], list[ToolCallLog]]:
+    logger.info(f"Calling tools: {', '.join(tu.name for tu in tool_uses)}")
+    # Независимые вызовы инструментов выполняются параллельно, порядок сохраняется
+    results = await jm_tools.execute_many([(tu.name, tu.input) for tu in tool_uses])
+    
+    # Ошибку инструмента (в т.ч. исключение) Claude видит как is_error и может
+    # повторить вызов или объяснить её, а остальные результаты хода не теряются
+    tool_results = [
+        {
+            "type": "tool_result",
+            "tool_use_id": tool_use.id,
+            "content": orjson.dumps(result).decode(),
+            "is_error": bool(result.get("err"))
+        }
+        for tool_use, result in zip(tool_uses, results)
+    ]
+    tool_calls = [
+        ToolCallLog(tool=tool_use.name, input=tool_use.input, result_preview=str(result)[:200])
+        for tool_use, result in zip(tool_uses, results)
+    ]
     
-    if conv_id not in conversations:
-        conversations[conv_id] = []
+    return tool_results, tool_calls
+
+
+# Семафор живёт, пока его держит хотя бы один запрос пользователя, — словарь не растёт
+_user_slots: WeakValueDictionary[str, asyncio.Semaphore] = WeakValueDictionary()
+
+
+async def _acquire_user_slot(message: ChatMessage, http_request: Request) -> asyncio.Semaphore:
+    # Лишние параллельные запросы отклоняем сразу, а не ставим в очередь: свободный семафор
+    # захватывается без ожидания, так что между проверкой и захватом нет переключения задач.
+    # Слот освобождает вызывающий. Без user_id ограничиваем по адресу клиента — за прокси
+    # uvicorn берёт его из X-Forwarded-For (--forwarded-allow-ips в nixpacks.toml)
+    user_key = message.user_id or (http_request.client.host if http_request.client else "anon")
+    slot = _user_slots.get(user_key)
+    if slot is None:
+        slot = _user_slots[user_key] = asyncio.Semaphore(CHAT_CONCURRENCY_PER_USER)
+    if slot.locked():
+        raise HTTPException(status_code=429, detail="Слишком много одновременных запросов")
+    await slot.acquire()
+    return slot
+
+
+# conv_id -> запись последнего хода, которая идёт уже после ответа клиенту. Следующий ход
+# того же диалога ждёт её перед загрузкой истории, иначе быстрый повторный запрос прочитал
+# бы историю без предыдущего хода. Гарантия действует в пределах процесса: с несколькими
+# воркерами следующий запрос может попасть в другой процесс, пока запись ещё идёт
+_pending_saves: dict[str, asyncio.Task] = {}
+
+
+async def _save_turn(conversations: ConversationStore, conv_id: str, turn: list):
+    _compact_tool_results(turn)
+    try:
+        await conversations.append(conv_id, turn)
+    except Exception:
+        logger.exception(f"Failed to save conversation {conv_id}")
+
+
+def _save_turn_later(conversations: ConversationStore, conv_id: str, turn: list):
+    task = asyncio.create_task(_save_turn(conversations, conv_id, turn))
+    _pending_saves[conv_id] = task
     
-    history = conversations[conv_id]
-    history.append({"role": "user", "content": request.message})
+    def forget(_):
+        if _pending_saves.get(conv_id) is task:
+            del _pending_saves[conv_id]
+    
+    task.add_done_callback(forget)
+
+
+async def _wait_pending_save(conv_id: str):
+    pending = _pending_saves.get(conv_id)
+    if pending is not None:
+        # shield: отмена этого запроса не должна прерывать запись предыдущего хода
+        await asyncio.shield(pending)
+
+
+async def _load_history(conversations: ConversationStore, conv_id: str) -> list:
+    await _wait_pending_save(conv_id)
+    return await conversations.load(conv_id)
+
+
+def _new_conversation_id(user_id: Optional[str]) -> str:
+    return f"conv_{user_id or 'anon'}_{secrets.token_urlsafe(8)}"
+
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def chat(
+    request: ChatMessage,
+    http_request: Request,
+    conversations: Conversations,
+    response_cache: ResponseCacheDep,
+    client: AnthropicClient,
+    jm_tools: JustMagic
+):
+    conv_id = request.conversation_id or _new_conversation_id(request.user_id)
     
+    slot = await _acquire_user_slot(request, http_request)
     try:
-        client = get_anthropic_client()
-        jm_tools = get_justmagic_tools()
+        history = await _load_history(conversations, conv_id)
+        # Сообщения этого хода: в хранилище дописываются только они
+        turn = []
         
-        response = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4096,
-            system=SYSTEM_PROMPT,
-            tools=TOOLS_DEFINITIONS,
-            messages=history
-        )
+        def add(message: dict):
+            history.append(message)
+            turn.append(message)
+        
+        add({"role": "user", "content": request.message})
+        response = await _ask_claude(client, response_cache, history, request.user_id)
         
         tool_calls_made = []
         
         while response.stop_reason == "tool_use":
             tool_uses = [block for block in response.content if block.type == "tool_use"]
-            history.append({"role": "assistant", "content": response.content})
-            
-            tool_results = []
-            for tool_use in tool_uses:
-                tool_name = tool_use.name
-                tool_input = tool_use.input
-                
-                logger.info(f"Calling tool: {tool_name}")
-                result = await jm_tools.execute(tool_name, tool_input)
-                
-                tool_calls_made.append({
-                    "tool": tool_name,
-                    "input": tool_input,
-                    "result_preview": str(result)[:200]
-                })
-                
-                tool_results.append({
-                    "type": "tool_result",
-                    "tool_use_id": tool_use.id,
-                    "content": json.dumps(result, ensure_ascii=False)
-                })
+            add({"role": "assistant", "content": _content_to_dicts(response.content)})
             
-            history.append({"role": "user", "content": tool_results})
+            tool_results, tool_calls = await _run_tools(jm_tools, tool_uses)
+            tool_calls_made.extend(tool_calls)
+            add({"role": "user", "content": tool_results})
             
-            response = client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=4096,
-                system=SYSTEM_PROMPT,
-                tools=TOOLS_DEFINITIONS,
-                messages=history
-            )
-        
-        final_text = ""
-        for block in response.content:
-            if hasattr(block, "text"):
-                final_text += block.text
+            response = await _ask_claude(client, response_cache, history, request.user_id)
         
-        history.append({"role": "assistant", "content": response.content})
+        final_text = "".join(block.text for block in response.content if block.type == "text")
         
-        if len(history) > 40:
-            conversations[conv_id] = history[-40:]
+        add({"role": "assistant", "content": _content_to_dicts(response.content)})
+        # Клиент не ждёт записи в Redis, а следующий ход диалога дождётся её в _load_history
+        _save_turn_later(conversations, conv_id, turn)
         
         return ChatResponse(
             response=final_text,
             tool_calls=tool_calls_made if tool_calls_made else None,
             conversation_id=conv_id
         )
-        
+    
     except anthropic.APIError as e:
         logger.error(f"Anthropic API error: {e}")
         raise HTTPException(status_code=500, detail=f"AI service error: {str(e)}")
     except Exception as e:
         logger.exception("Chat error")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        slot.release()
+
+
+def _sse(event: str, data: dict) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(
+    request: ChatMessage,
+    http_request: Request,
+    conversations: Conversations,
+    response_cache: ResponseCacheDep,
+    client: AnthropicClient,
+    jm_tools: JustMagic
+):
+    # Тот же диалог, что и /api/chat, но текст уходит клиенту по мере генерации (SSE):
+    # start → delta… → tool_call → delta… → done | error
+    conv_id = request.conversation_id or _new_conversation_id(request.user_id)
+    
+    # Слот занимаем до начала ответа — лишний запрос получает 429, а не событие error.
+    # Освобождает его генератор, когда поток закончится или клиент отключится
+    slot = await _acquire_user_slot(request, http_request)
+    
+    async def events():
+        try:
+            yield _sse("start", {"conversation_id": conv_id})
+            history = await _load_history(conversations, conv_id)
+            turn = []
+            
+            def add(message: dict):
+                history.append(message)
+                turn.append(message)
+            
+            add({"role": "user", "content": request.message})
+            while True:
+                key = _response_key(history)
+                response = await _cached_response(response_cache, key)
+                if response is not None:
+                    text = "".join(block.text for block in response.content if block.type == "text")
+                    yield _sse("delta", {"text": text})
+                else:
+                    async with client.messages.stream(**_claude_request(history, request.user_id)) as stream:
+                        async for text in stream.text_stream:
+                            yield _sse("delta", {"text": text})
+                        response = await stream.get_final_message()
+                    _log_usage(response.usage)
+                    await _remember_response(response_cache, key, response)
+                add({"role": "assistant", "content": _content_to_dicts(response.content)})
+                if response.stop_reason != "tool_use":
+                    break
+                
+                tool_uses = [block for block in response.content if block.type == "tool_use"]
+                yield _sse("tool_call", {"tools": [tu.name for tu in tool_uses]})
+                tool_results, _ = await _run_tools(jm_tools, tool_uses)
+                add({"role": "user", "content": tool_results})
+            
+            # Запись регистрируется до done: следующий ход, отправленный сразу после done,
+            # дождётся её в _load_history
+            _save_turn_later(conversations, conv_id, turn)
+            yield _sse("done", {"conversation_id": conv_id})
+        
+        except anthropic.APIError as e:
+            logger.error(f"Anthropic API error: {e}")
+            yield _sse("error", {"detail": f"AI service error: {str(e)}"})
+        except Exception as e:
+            logger.exception("Chat stream error")
+            yield _sse("error", {"detail": str(e)})
+        finally:
+            slot.release()
+
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # identity: GZipMiddleware пропускает ответ как есть и не копит дельты в буфере сжатия
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Content-Encoding": "identity"}
+    )
 
 
 @app.post("/api/clear")
-async def clear_conversation(conversation_id: str):
-    if conversation_id in conversations:
-        del conversations[conversation_id]
+async def clear_conversation(conversation_id: str, conversations: Conversations):
+    # Иначе запись последнего хода, завершившись после очистки, вернула бы историю
+    await _wait_pending_save(conversation_id)
+    await conversations.clear(conversation_id)
     return {"status": "ok"}
 
 
 @app.get("/api/tasks")
-async def list_tasks(limit: int = 10):
+async def list_tasks(jm_tools: JustMagic, limit: int = 10):
     try:
-        jm_tools = get_justmagic_tools()
         result = await jm_tools.execute("justmagic_list_tasks", {"limit": limit})
         return result
     except Exception as e:
@@ -218,9 +555,8 @@ async def list_tasks(limit: int = 10):
 
 
 @app.get("/api/tasks/{tid}")
-async def get_task(tid: int):
+async def get_task(tid: int, jm_tools: JustMagic):
     try:
-        jm_tools = get_justmagic_tools()
         result = await jm_tools.execute("justmagic_get_task", {"tid": tid, "mode": "info"})
         return result
     except Exception as e:
@@ -228,18 +564,27 @@ async def get_task(tid: int):
 
 
 @app.get("/api/account")
-async def get_account_info():
+async def get_account_info(jm_tools: JustMagic):
     try:
-        jm_tools = get_justmagic_tools()
         result = await jm_tools.execute("justmagic_info", {})
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Файлы с хэшем содержимого в имени (app.3f2a9c1d.js) не меняются — кэшируем навсегда;
+# остальные браузер перепроверяет по ETag/Last-Modified и получает 304
+HASHED_ASSET = re.compile(r"\.[0-9a-f]{8,}\.\w+$")
+
+
+class CachedStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if HASHED_ASSET.search(str(full_path)):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response
 
 
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+app.mount("/static", CachedStaticFiles(directory="static", check_dir=False), name="static")
@@ -0,0 +1,63 @@
+"""
+Кэш готовых ответов Claude по точному хэшу запроса: в памяти процесса и в Redis
+"""
+
+import time
+from abc import ABC, abstractmethod
+
+import redis.asyncio as redis
+
+
+class ResponseCache(ABC):
+    # Ключ — sha256 всего запроса к Claude (модель, system, tools, история),
+    # значение — JSON ответа. Все записи живут одинаковый ttl
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    @abstractmethod
+    async def get(self, key: str) -> bytes | None:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes):
+        ...
+
+
+class MemoryResponseCache(ResponseCache):
+    # TTL у всех записей одинаковый, поэтому порядок вставки совпадает с порядком
+    # истечения — при переполнении выбрасываем первую запись
+
+    def __init__(self, ttl: int, max_size: int):
+        super().__init__(ttl)
+        self.max_size = max_size
+        self._data: dict[str, tuple[float, bytes]] = {}
+
+    async def get(self, key: str) -> bytes | None:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def set(self, key: str, value: bytes):
+        self._data.pop(key, None)
+        if len(self._data) >= self.max_size:
+            del self._data[next(iter(self._data))]
+        self._data[key] = (time.monotonic() + self.ttl, value)
+
+
+class RedisResponseCache(ResponseCache):
+
+    def __init__(self, client: redis.Redis, ttl: int):
+        super().__init__(ttl)
+        self.redis = client
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.redis.get(f"resp:exact:{key}")
+
+    async def set(self, key: str, value: bytes):
+        await self.redis.set(f"resp:exact:{key}", value, ex=self.ttl)
@@ -0,0 +1,29 @@
+import asyncio
+
+from conversation_store import MemoryConversationStore
+
+
+def turn(n: int, tool_calls: int) -> list[dict]:
+    messages = [{"role": "user", "content": f"вопрос {n}"}]
+    for i in range(tool_calls):
+        messages.append({"role": "assistant", "content": [{"type": "tool_use", "id": f"{n}-{i}"}]})
+        messages.append({"role": "user", "content": [{"type": "tool_result", "tool_use_id": f"{n}-{i}"}]})
+    messages.append({"role": "assistant", "content": [{"type": "text", "text": "ответ"}]})
+    return messages
+
+
+def test_history_keeps_last_whole_turns():
+    async def run():
+        store = MemoryConversationStore(max_turns=3, ttl=60, max_size=10, sweep_interval=60)
+        turns = []
+        for n in range(30):
+            history = await store.load("c")
+            messages = turn(n, n % 4)
+            history.extend(messages)
+            turns.append(messages)
+            await store.append("c", messages)
+            # Обрезка целыми ходами: история начинается с текста пользователя
+            # и не рвёт пары tool_use/tool_result
+            assert await store.load("c") == [message for t in turns[-3:] for message in t]
+
+    asyncio.run(run())
@@ -0,0 +1,162 @@
+import asyncio
+import gzip
+
+import httpx
+import pytest
+
+import justmagic_tools
+from justmagic_tools import JustMagicTools
+
+CSV = 'Запрос\tГруппа\n0\t"x\ny"\n1\t"a\tb"\n2\t"длинное\nполе\nс ""кавычками"""\n3\tz\n'
+ROWS = [
+    ["Запрос", "Группа"],
+    ["0", "x\ny"],
+    ["1", "a\tb"],
+    ["2", 'длинное\nполе\nс "кавычками"'],
+    ["3", "z"],
+]
+
+
+def download(body: bytes, **args) -> dict:
+    async def run():
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body))
+        async with httpx.AsyncClient(transport=transport) as client:
+            tools = JustMagicTools("key", client)
+            return await tools.execute("justmagic_download_result", {"tid": 1, **args})
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("chunk_size", [2, 3, 7, 64 * 1024])
+@pytest.mark.parametrize("compress", [False, True])
+def test_download_keeps_quoted_newlines(monkeypatch, chunk_size, compress):
+    # Мелкие куски разрезают поля в кавычках и многобайтные символы между чтениями
+    monkeypatch.setattr(justmagic_tools, "READ_CHUNK_SIZE", chunk_size)
+    body = CSV.encode()
+    result = download(gzip.compress(body) if compress else body)
+    assert result["data"] == ROWS
+    assert result["total_rows"] == len(ROWS)
+
+
+def test_download_stops_after_max_rows(monkeypatch):
+    monkeypatch.setattr(justmagic_tools, "READ_CHUNK_SIZE", 5)
+    result = download(CSV.encode(), max_rows=2)
+    assert result["data"] == ROWS[:2]
+    assert result["total_rows"] is None
+
+
+def test_download_without_trailing_newline():
+    result = download(CSV.rstrip("\n").encode())
+    assert result["data"] == ROWS
+
+
+@pytest.mark.parametrize("max_rows", [0, -1, -5])
+def test_download_rejects_non_positive_max_rows(max_rows):
+    result = download(CSV.encode(), max_rows=max_rows)
+    assert result["err"] == "bad_args"
+
+
+def test_final_http_error_is_not_parsed_as_json(monkeypatch):
+    monkeypatch.setattr(justmagic_tools, "RETRY_BACKOFF", 0)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503, content=b"<html>Service Unavailable</html>")
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await JustMagicTools("key", client).execute("justmagic_info", {})
+
+    assert asyncio.run(run()) == {"err": "http_error", "errtxt": "HTTP 503"}
+    assert len(calls) == justmagic_tools.RETRY_ATTEMPTS
+
+
+def test_query_lists_are_sent_as_raw_utf8_multipart():
+    queries = [f"купить диван {i}" for i in range(100)]
+    sent = []
+
+    def handler(request):
+        sent.append(request)
+        return httpx.Response(200, json={"err": 0})
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            tools = JustMagicTools("key", client)
+            await tools.execute("justmagic_cluster", {"queries": queries})
+            await tools.execute("justmagic_info", {})
+
+    asyncio.run(run())
+    cluster, info = sent
+    assert cluster.headers["content-type"].startswith("multipart/form-data; boundary=")
+    # Кириллица уходит без процентного кодирования
+    assert "\n".join(queries).encode() in cluster.content
+    assert info.headers["content-type"] == "application/x-www-form-urlencoded"
+    assert info.content == b"action=info&apikey=key"
+
+
+def test_bare_quote_does_not_block_early_stop(monkeypatch):
+    # Голая кавычка в поле без кавычек не открывает поле — разбор не ждёт её пары до конца файла
+    monkeypatch.setattr(justmagic_tools, "READ_CHUNK_SIZE", 64)
+    pulled = []
+
+    async def body():
+        yield 'Запрос\tГруппа\n1\t27" монитор\n'.encode()
+        for i in range(1000):
+            pulled.append(i)
+            yield "".join(f"{i}-{j}\tгруппа\n" for j in range(10)).encode()
+
+    async def run():
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body()))
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await JustMagicTools("key", client).execute("justmagic_download_result", {"tid": 1, "max_rows": 5})
+
+    result = asyncio.run(run())
+    assert result["data"][:2] == [["Запрос", "Группа"], ["1", '27" монитор']]
+    assert result["total_rows"] is None
+    assert len(pulled) < 5
+
+
+@pytest.mark.parametrize("failures, expected", [(2, "data"), (3, "no_data")])
+def test_download_retries_error_pages(monkeypatch, failures, expected):
+    monkeypatch.setattr(justmagic_tools, "RETRY_BACKOFF", 0)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) <= failures:
+            return httpx.Response(502, content=b"<html>bad gateway</html>")
+        return httpx.Response(200, content=CSV.encode())
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await JustMagicTools("key", client).execute("justmagic_download_result", {"tid": 1})
+
+    result = asyncio.run(run())
+    assert len(calls) == justmagic_tools.RETRY_ATTEMPTS
+    if expected == "data":
+        assert result["data"] == ROWS
+    else:
+        assert result["err"] == "no_data"
+
+
+def test_truncated_gzip_is_reported_as_no_data():
+    result = download(gzip.compress(CSV.encode())[:-5])
+    assert result["err"] == "no_data"
+
+
+@pytest.mark.parametrize("tool", justmagic_tools.TOOLS_DEFINITIONS, ids=lambda tool: tool["name"])
+def test_arg_models_match_tool_schemas(tool):
+    # Значения по умолчанию и enum объявлены дважды — в схеме для Claude и в модели,
+    # которая их применяет; тест держит их в согласии
+    model = justmagic_tools._ARG_MODELS[tool["name"]]
+    schema = tool["input_schema"]
+    model_schema = model.model_json_schema()
+    assert set(schema["properties"]) == set(model.model_fields)
+    assert set(schema["required"]) == {name for name, field in model.model_fields.items() if field.is_required()}
+    for name, prop in schema["properties"].items():
+        field = model.model_fields[name]
+        if not field.is_required():
+            assert field.default == prop.get("default"), name
+        for key in ("enum", "minimum"):
+            assert prop.get(key) == model_schema["properties"][name].get(key), (name, key)